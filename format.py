@@ -2,11 +2,276 @@ import streamlit as st
 import openai
 import docx
 import io
+import os
+import copy
+import numpy as np
+import re
+import json
+import asyncio
+import logging
+import hashlib
+import sqlite3
+from contextlib import closing
+from typing import Annotated, Literal
+from pydantic import BaseModel, BeforeValidator
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from docx.shared import Pt, Inches, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.enum.style import WD_STYLE_TYPE
+from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_UNDERLINE
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
 
-def extract_formatting_from_docx(doc):
-    """Extract formatting details from a reference Word document"""
+logger = logging.getLogger(__name__)
+
+# WordprocessingML tags read directly when walking the document XML
+W_P = qn("w:p")
+W_PPR = qn("w:pPr")
+W_PSTYLE = qn("w:pStyle")
+W_OUTLINE_LVL = qn("w:outlineLvl")
+W_JC = qn("w:jc")
+W_R = qn("w:r")
+W_RPR = qn("w:rPr")
+W_T = qn("w:t")
+W_TAB = qn("w:tab")
+W_BR = qn("w:br")
+W_CR = qn("w:cr")
+W_TYPE = qn("w:type")
+W_B = qn("w:b")
+W_I = qn("w:i")
+W_U = qn("w:u")
+W_RFONTS = qn("w:rFonts")
+W_SZ = qn("w:sz")
+W_COLOR = qn("w:color")
+W_VAL = qn("w:val")
+W_ASCII = qn("w:ascii")
+
+# Paragraphs the local heuristic is unsure about go to the cheap model,
+# the ones it has almost no signal on are escalated to the stronger one
+CLASSIFICATION_MODEL = "gpt-4o-mini"
+ESCALATION_MODEL = "gpt-4o"
+
+# Kept byte-identical across requests, and over OpenAI's 1024 token minimum, so the prompt prefix is cached
+CLASSIFICATION_RUBRIC = """You are a document formatting assistant. You will receive a numbered list of
+paragraphs taken from a Word document, in document order. Classify each paragraph as
+either 'heading' or 'body' based on its content and context.
+
+Classification rubric:
+- 'heading': a title, chapter, section or subsection name that introduces the text
+  that follows it. Headings are usually short, often use title case or all capitals,
+  may be numbered ("1.", "2.3", "Chapter 4", "Appendix A"), and usually do not end
+  with a full stop.
+- 'heading': short labels that stand alone above a block of text, such as
+  "Introduction", "Summary", "Terms and Conditions" or "Frequently Asked Questions".
+- 'body': running text made of one or more complete sentences, usually ending with
+  terminal punctuation.
+- 'body': list items, captions, quotes, signatures, addresses, dates, page numbers
+  and any other line that does not introduce a section.
+- When a paragraph could be either, prefer 'body' unless it clearly introduces the
+  paragraphs that follow it.
+
+Labelled examples of headings:
+- "Introduction" -> heading
+- "1. Background" -> heading
+- "2.3 Scope of Work" -> heading
+- "Chapter 4: Results and Discussion" -> heading
+- "Appendix A - Glossary of Terms" -> heading
+- "EXECUTIVE SUMMARY" -> heading
+- "Terms and Conditions" -> heading
+- "Frequently Asked Questions" -> heading
+- "Part II. Financial Statements" -> heading
+- "Section 7 - Termination" -> heading
+- "Methodology" -> heading
+- "Key Findings" -> heading
+- "Roles and Responsibilities" -> heading
+- "Risk Assessment and Mitigation" -> heading
+- "Project Timeline" -> heading
+- "Acknowledgements" -> heading
+- "References" -> heading
+- "Table of Contents" -> heading
+- "How to Apply" -> heading
+- "What You Need to Know Before You Start" -> heading
+- "Why This Matters" -> heading
+- "Next Steps:" -> heading
+- "Q3 2024 Performance Review" -> heading
+- "Meeting Minutes - 12 March" -> heading
+- "Article 12. Governing Law" -> heading
+- "Lesson 5: Fractions and Decimals" -> heading
+- "Installation" -> heading
+- "Troubleshooting Common Problems" -> heading
+- "Contact Information" -> heading
+- "Conclusion" -> heading
+- "3.1.2 Data Collection Procedures" -> heading
+- "Background and Rationale" -> heading
+- "Scope" -> heading
+- "Definitions" -> heading
+- "Payment Terms" -> heading
+- "Health and Safety Guidelines" -> heading
+- "Module 2 - Getting Started" -> heading
+- "Recommendations" -> heading
+- "Budget Overview" -> heading
+- "Schedule B: Pricing" -> heading
+- "Limitations of the Study" -> heading
+- "Our Mission" -> heading
+- "Warranty Information" -> heading
+- "Before You Begin" -> heading
+- "Summary of Changes" -> heading
+
+Labelled examples of body text:
+- "This report summarises the results of the customer survey carried out in May." -> body
+- "The contractor shall deliver all materials no later than thirty days after signing." -> body
+- "Please read these instructions carefully before using the device." -> body
+- "In 2023, revenue grew by 12% compared with the previous year, driven mainly by exports." -> body
+- "We would like to thank everyone who contributed to this project." -> body
+- "See Figure 3 for a breakdown of costs by department." -> body
+- "Figure 3: Costs by department" -> body
+- "Table 2. Summary of survey responses" -> body
+- "Yours sincerely," -> body
+- "Jane Smith, Head of Operations" -> body
+- "221B Baker Street, London" -> body
+- "12 March 2024" -> body
+- "Page 4 of 10" -> body
+- "Confidential - do not distribute" -> body
+- "Apples, oranges and pears" -> body
+- "Install the latest version of the software" -> body
+- "Click Save to keep your changes" -> body
+- "Total: $4,250.00" -> body
+- "Tel: +44 20 7946 0000" -> body
+- "\"The best way to predict the future is to invent it.\"" -> body
+- "Note: prices exclude VAT." -> body
+- "For more information, visit our website." -> body
+- "If the problem persists, contact support." -> body
+- "Each participant received a consent form and a short questionnaire." -> body
+- "The following sections describe each step in detail." -> body
+- "Approved by the board on 3 June." -> body
+- "All rights reserved." -> body
+- "Step 1 - open the cover and remove the battery" -> body
+- "The committee met four times during the reporting period." -> body
+- "Responses were anonymised before analysis." -> body
+- "Both parties agree to keep the terms of this agreement confidential." -> body
+- "The new policy takes effect from the first day of next month." -> body
+- "Participants were recruited through local community centres and online forums." -> body
+- "Remove the packaging and check that all parts are present" -> body
+- "Monday to Friday, 9am to 5pm" -> body
+- "Source: Office for National Statistics" -> body
+- "Prepared by the Finance Team" -> body
+- "Version 2.1, last updated January 2024" -> body
+- "Invoice number INV-20931" -> body
+- "Thank you for choosing our service!" -> body
+- "This section explains how the budget was calculated and which assumptions were made." -> body
+- "Any changes must be agreed in writing by both parties." -> body
+- "Results are shown in the table below" -> body
+- "Signed on behalf of the Company" -> body
+- "Attendees: A. Patel, R. Jones, M. Chen" -> body
+
+Respond with a JSON object containing exactly one label per numbered paragraph, in the
+same order as the input, with each label on its own line:
+{
+  "labels": [
+    "heading",
+    "body",
+    "body"
+  ]
+}
+Do not include the paragraph text, explanations or any other keys in the response."""
+
+# Matches the labels on one line of the streamed JSON response
+LABEL_PATTERN = re.compile(r'"(heading|body)"', re.IGNORECASE)
+
+# Paragraphs are classified in chunks of this size, dispatched concurrently
+CLASSIFICATION_CHUNK_SIZE = 25
+
+# When the Batch API is enabled, documents with more paragraphs than this are sent through it
+BATCH_API_THRESHOLD = 50
+BATCH_CHUNK_SIZE = 20
+BATCH_POLL_INTERVAL = 10
+
+# Labels of previously classified paragraph texts are kept here across sessions. The file lives
+# next to this module unless FORMATTER_CACHE_DIR points somewhere else (e.g. a writable volume)
+CLASSIFICATION_CACHE_PATH = os.path.join(
+    os.environ.get("FORMATTER_CACHE_DIR", os.path.dirname(os.path.abspath(__file__))),
+    "classification_cache.sqlite3"
+)
+
+# Local heading detection: headings are short, capitalised, bold and don't end like a sentence
+HEADING_MAX_LENGTH = 80
+TERMINAL_PUNCTUATION = (".", "!", "?", ";", ",")
+
+# Page numbers, short numeric labels and bare punctuation are always body text
+TRIVIAL_PARAGRAPH_PATTERN = re.compile(r"^[\W\d\s]{0,4}$")
+
+# Local heading scores above the midpoint lean towards heading, below it towards body.
+# The distance from the midpoint over the scale gives the confidence of the local label
+HEADING_SCORE_MIDPOINT = 0.3
+HEADING_SCORE_SCALE = 0.375
+
+# Local labels are accepted above this confidence, and ESCALATION_MODEL is used below the lower one
+LOCAL_CONFIDENCE = 0.8
+ESCALATION_CONFIDENCE = 0.4
+
+def _read_attribute(parent, tag, attribute):
+    """Return an attribute of the first child with the given tag, or None"""
+    if parent is None:
+        return None
+    child = parent.find(tag)
+    return child.get(attribute) if child is not None else None
+
+def _read_toggle(rPr, tag):
+    """Read an on/off run property like w:b the way python-docx does (None when unset)"""
+    toggle = rPr.find(tag) if rPr is not None else None
+    if toggle is None:
+        return None
+    return toggle.get(W_VAL) not in ("0", "false", "off")
+
+def _read_underline(rPr):
+    """Read the w:u run property the way python-docx's Run.underline does"""
+    val = _read_attribute(rPr, W_U, W_VAL)
+    if val is None:
+        return None
+    if val in ("single", "none"):
+        return val == "single"
+    return WD_UNDERLINE.from_xml(val)
+
+def _xml_text(element):
+    """Concatenate the text of every w:t node under an element"""
+    return "".join(t.text or "" for t in element.iter(W_T))
+
+def _paragraph_runs(p):
+    """
+    Return a paragraph's own runs, directly or inside hyperlinks, like python-docx's Paragraph.runs.
+    Runs of text boxes anchored in the paragraph are nested deeper and are left out.
+    """
+    return p.xpath("./w:r | ./w:hyperlink/w:r")
+
+def _run_text(r):
+    """Concatenate the text of a run's own children, mapping tabs and breaks like CT_R.text"""
+    parts = []
+    for child in r.iterchildren():
+        if child.tag == W_T:
+            parts.append(child.text or "")
+        elif child.tag == W_TAB:
+            parts.append("\t")
+        elif child.tag == W_CR or (child.tag == W_BR and child.get(W_TYPE, "textWrapping") == "textWrapping"):
+            parts.append("\n")
+    
+    return "".join(parts)
+
+def _paragraph_text(p):
+    """Concatenate the text of a paragraph's own runs"""
+    return "".join(_run_text(r) for r in _paragraph_runs(p))
+
+def _paragraph_style_names(doc):
+    """Return a style id to style name map and the name of the default paragraph style"""
+    style_names = {style.style_id: style.name for style in doc.styles}
+    default_style = doc.styles.default(WD_STYLE_TYPE.PARAGRAPH)
+    return style_names, default_style.name if default_style is not None else "Normal"
+
+def extract_formatting_from_docx(doc, full=False, max_table_cells=1):
+    """
+    Extract formatting details from a reference Word document.
+    Only the first heading and body paragraph, and up to max_table_cells cells with distinct
+    vertical alignments per table, are captured unless full is True, since only those
+    samples are used when applying the formatting.
+    """
     formatting = {
         "paragraphs": [],
         "headings": [],
@@ -14,35 +279,51 @@ def extract_formatting_from_docx(doc):
         "overall_style": {}
     }
     
-    # Extract paragraph formatting
-    for para in doc.paragraphs:
-        if para.text.strip():  # Skip empty paragraphs
+    # Extract paragraph formatting straight from the XML instead of python-docx proxies
+    style_names, default_style_name = _paragraph_style_names(doc)
+    
+    for p in doc.element.body.iterchildren(W_P):
+        text = _paragraph_text(p)
+        if text.strip():  # Skip empty paragraphs
+            pPr = p.find(W_PPR)
+            style_name = style_names.get(_read_attribute(pPr, W_PSTYLE, W_VAL), default_style_name)
+            
+            # Categorize as heading or paragraph, skipping categories we already have a sample of
+            category = "headings" if "Heading" in style_name else "paragraphs"
+            if not full and formatting[category]:
+                continue
+            
+            jc = _read_attribute(pPr, W_JC, W_VAL)
             style_info = {
-                "text": para.text,
-                "alignment": para.alignment,
-                "style_name": para.style.name if para.style else "Normal",
+                "text": text,
+                "alignment": WD_ALIGN_PARAGRAPH.from_xml(jc) if jc else None,
+                "style_name": style_name,
                 "font_properties": []
             }
             
             # Extract run properties (font, size, bold, italic, etc.)
-            for run in para.runs:
-                if run.text.strip():
+            for r in _paragraph_runs(p):
+                run_text = _run_text(r)
+                if run_text.strip():
+                    rPr = r.find(W_RPR)
+                    size = _read_attribute(rPr, W_SZ, W_VAL)
+                    color = _read_attribute(rPr, W_COLOR, W_VAL)
                     run_props = {
-                        "text": run.text,
-                        "bold": run.bold,
-                        "italic": run.italic,
-                        "underline": run.underline,
-                        "font_name": run.font.name if run.font else None,
-                        "font_size": run.font.size.pt if run.font.size else None,
-                        "color": run.font.color.rgb if run.font.color and run.font.color.rgb else None
+                        "text": run_text,
+                        "bold": _read_toggle(rPr, W_B),
+                        "italic": _read_toggle(rPr, W_I),
+                        "underline": _read_underline(rPr),
+                        "font_name": _read_attribute(rPr, W_RFONTS, W_ASCII),
+                        "font_size": float(size) / 2 if size else None,  # w:sz is in half-points
+                        "color": color if color and color != "auto" else None  # Hex string like "1F3864"
                     }
                     style_info["font_properties"].append(run_props)
             
-            # Categorize as heading or paragraph
-            if para.style and "Heading" in para.style.name:
-                formatting["headings"].append(style_info)
-            else:
-                formatting["paragraphs"].append(style_info)
+            formatting[category].append(style_info)
+            
+            # Stop once there is a sample heading and body paragraph
+            if not full and formatting["headings"] and formatting["paragraphs"]:
+                break
     
     # Extract table formatting - fixed to avoid the get_or_add_shd error
     for table in doc.tables:
@@ -52,200 +333,561 @@ def extract_formatting_from_docx(doc):
             "cell_styles": []
         }
         
+        seen_alignments = set()
         for row in table.rows:
             for cell in row.cells:
+                vertical_alignment = cell.vertical_alignment
+                
+                # Keep one sample cell per vertical alignment unless full extraction was requested
+                if not full:
+                    if vertical_alignment in seen_alignments:
+                        continue
+                    seen_alignments.add(vertical_alignment)
+                
                 cell_info = {
-                    "text": cell.text,
-                    "vertical_alignment": cell.vertical_alignment
+                    "text": _xml_text(cell._tc),
+                    "vertical_alignment": vertical_alignment
                 }
                 # We'll skip the shading extraction that was causing the error
                 table_info["cell_styles"].append(cell_info)
+                
+                if not full and len(table_info["cell_styles"]) >= max_table_cells:
+                    break
+            
+            # Stop walking the table once enough sample cells were captured
+            if not full and len(table_info["cell_styles"]) >= max_table_cells:
+                break
         
         formatting["tables"].append(table_info)
     
-    # Extract document-wide properties
+    # Extract document-wide properties, looking up the Normal style and first section only once
+    normal_font = doc.styles["Normal"].font if "Normal" in doc.styles else None
+    normal_size = normal_font.size if normal_font is not None else None
+    section = doc.sections[0] if doc.sections else None
     formatting["overall_style"] = {
-        "default_font": doc.styles["Normal"].font.name if "Normal" in doc.styles else None,
-        "default_font_size": doc.styles["Normal"].font.size.pt if "Normal" in doc.styles and doc.styles["Normal"].font.size else None,
+        "default_font": normal_font.name if normal_font is not None else None,
+        "default_font_size": normal_size.pt if normal_size else None,
         "margins": {
-            "top": doc.sections[0].top_margin.inches if doc.sections else None,
-            "bottom": doc.sections[0].bottom_margin.inches if doc.sections else None,
-            "left": doc.sections[0].left_margin.inches if doc.sections else None,
-            "right": doc.sections[0].right_margin.inches if doc.sections else None
+            "top": section.top_margin.inches if section else None,
+            "bottom": section.bottom_margin.inches if section else None,
+            "left": section.left_margin.inches if section else None,
+            "right": section.right_margin.inches if section else None
         }
     }
     
     return formatting
 
-def apply_formatting_to_docx(target_doc, formatting_info, openai_client):
+def classify_by_style(p, style_name):
+    """Return 'heading' if a w:p paragraph element's style or outline level marks it as one, else None"""
+    if "Heading" in style_name or "Title" in style_name:
+        return "heading"
+    
+    # Outline levels 0-8 mark headings, level 9 is body text
+    outline_level = _read_attribute(p.find(W_PPR), W_OUTLINE_LVL, W_VAL)
+    if outline_level is not None and int(outline_level) < 9:
+        return "heading"
+    
+    return None
+
+def is_trivial_paragraph(text):
+    """Return True for paragraphs that never need classifying, like page numbers or bare punctuation"""
+    text = text.strip()
+    return len(text) < 3 or text.isdigit() or TRIVIAL_PARAGRAPH_PATTERN.match(text) is not None
+
+def heading_features(p, text):
+    """Return the length, capitalised word ratio, bold run ratio and sentence ending of a paragraph"""
+    text = text.strip()
+    words = text.split()
+    cap_ratio = sum(word[0].isupper() for word in words) / len(words) if words else 0.0
+    
+    bold = [_read_toggle(r.find(W_RPR), W_B) for r in _paragraph_runs(p) if _run_text(r).strip()]
+    bold_frac = sum(1 for b in bold if b) / len(bold) if bold else 0.0
+    
+    return len(text), cap_ratio, bold_frac, float(text.endswith(TERMINAL_PUNCTUATION))
+
+def score_headings(features):
+    """Score paragraph features in one vectorized pass, higher scores are more heading-like"""
+    lengths, cap_ratio, bold_frac, ends_sentence = np.asarray(features, dtype=np.float32).reshape(-1, 4).T
+    return cap_ratio * 0.5 + bold_frac * 0.4 - ends_sentence * 0.3 - (lengths > HEADING_MAX_LENGTH) * 0.6
+
+def classify_by_features(features):
     """
-    Apply formatting from reference document to target document using OpenAI.
-    This function will use OpenAI to understand the document structure and 
-    then apply the formatting from the reference document.
+    Classify paragraphs as 'heading' or 'body' from their heading_features.
+    Returns the labels and their confidence between 0 and 1. Labels are None where the
+    confidence is too low to accept them and the paragraph should be classified by OpenAI.
     """
-    # Extract content from target document
-    content = []
-    for para in target_doc.paragraphs:
-        if para.text.strip():
-            content.append({"type": "paragraph", "text": para.text})
+    scores = score_headings(features)
+    confidence = np.clip(np.abs(scores - HEADING_SCORE_MIDPOINT) / HEADING_SCORE_SCALE, 0.0, 1.0)
+    labels = np.where(scores > HEADING_SCORE_MIDPOINT, "heading", "body").astype(object)
+    labels[confidence <= LOCAL_CONFIDENCE] = None
+    return labels.tolist(), confidence.tolist()
+
+def route_model(confidence):
+    """Pick the OpenAI model for a paragraph from the confidence of its local label"""
+    return CLASSIFICATION_MODEL if confidence >= ESCALATION_CONFIDENCE else ESCALATION_MODEL
+
+def build_classification_system_prompt(formatting_info):
+    """
+    Build the system prompt from the classification rubric and the reference style guide.
+    It only depends on the reference document, so it stays identical for every request.
+    """
+    style_guide = {
+        "overall_style": formatting_info["overall_style"],
+        "heading_examples": [h["text"] for h in formatting_info["headings"]],
+        "body_examples": [p["text"] for p in formatting_info["paragraphs"]]
+    }
+    return (
+        CLASSIFICATION_RUBRIC
+        + "\n\nThe document will be formatted like a reference document with this style guide:\n"
+        + json.dumps(style_guide, sort_keys=True, default=str)
+    )
+
+def build_classification_request(texts, system_prompt, model=CLASSIFICATION_MODEL):
+    """Build the chat completion arguments asking OpenAI to label each paragraph"""
+    prompt = "Classify the following paragraphs:\n"
+    for i, text in enumerate(texts):
+        prompt += f"\n[{i}] {text}"
     
-    # Create a new document that will have the formatting applied
-    new_doc = docx.Document()
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ],
+        "response_format": {"type": "json_object"},
+        "max_tokens": 1500
+    }
+
+class Classification(BaseModel):
+    """Structured classification response from OpenAI, one label per paragraph"""
+    labels: list[Annotated[
+        Literal["heading", "body"],
+        BeforeValidator(lambda label: label.strip().lower() if isinstance(label, str) else label)
+    ]]
+
+def parse_classification_labels(raw_content, expected_count):
+    """Validate the JSON labels returned by OpenAI into a list of 'heading'/'body' strings"""
+    labels = Classification.model_validate_json(raw_content).labels
+    if len(labels) != expected_count:
+        raise ValueError(f"Expected {expected_count} labels from OpenAI, got {len(labels)}")
     
-    # Set document-wide properties
-    overall_style = formatting_info["overall_style"]
-    if overall_style.get("margins"):
-        for section in new_doc.sections:
-            if overall_style["margins"].get("top"):
-                section.top_margin = Inches(overall_style["margins"]["top"])
-            if overall_style["margins"].get("bottom"):
-                section.bottom_margin = Inches(overall_style["margins"]["bottom"])
-            if overall_style["margins"].get("left"):
-                section.left_margin = Inches(overall_style["margins"]["left"])
-            if overall_style["margins"].get("right"):
-                section.right_margin = Inches(overall_style["margins"]["right"])
-    
-    # Use OpenAI to identify paragraphs vs headings in the target document
-    prompt = """
-    Analyze the following document content and classify each paragraph as either 'heading' or 'body':
+    return labels
+
+@retry(
+    retry=retry_if_exception_type(
+        (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError, ValueError)
+    ),
+    wait=wait_exponential(multiplier=1, min=1, max=4),
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+async def classify_chunk(openai_client, chunk, system_prompt, model=CLASSIFICATION_MODEL, on_label=None):
+    """
+    Classify one chunk of paragraph texts, retrying with exponential backoff on transient or invalid replies.
+    The response is streamed and on_label(index, label) is called early for each line holding
+    a single label. These early labels are provisional; the returned, validated labels are final.
+    """
+    stream = await openai_client.chat.completions.create(
+        **build_classification_request(chunk, system_prompt, model),
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    
+    buffer = ""
+    line_start = 0
+    streamed = 0
+    async for event in stream:
+        if event.usage:
+            details = getattr(event.usage, "prompt_tokens_details", None)
+            if details and details.cached_tokens:
+                logger.info("OpenAI reused %d cached prompt tokens", details.cached_tokens)
+        if not event.choices:
+            continue
+        
+        buffer += event.choices[0].delta.content or ""
+        
+        # Report completed lines holding exactly one label; lines with several labels still
+        # advance the index but are left to the validated result
+        newline = buffer.find("\n", line_start)
+        while newline != -1:
+            labels = LABEL_PATTERN.findall(buffer, line_start, newline)
+            if len(labels) == 1 and on_label and streamed < len(chunk):
+                on_label(streamed, labels[0].lower())
+            streamed += len(labels)
+            line_start = newline + 1
+            newline = buffer.find("\n", line_start)
+    
+    # Validate the complete response, the caller applies these labels over the provisional ones
+    return parse_classification_labels(buffer, len(chunk))
+
+async def classify_paragraphs_with_batch_api(openai_client, texts, system_prompt, model=CLASSIFICATION_MODEL):
+    """Classify paragraphs through the OpenAI Batch API, one request per chunk of paragraphs"""
+    chunks = [texts[i:i + BATCH_CHUNK_SIZE] for i in range(0, len(texts), BATCH_CHUNK_SIZE)]
+    
+    # Write one chat completion request per chunk into a JSONL payload
+    requests_jsonl = "\n".join(
+        json.dumps({
+            "custom_id": f"chunk-{n}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_classification_request(chunk, system_prompt, model)
+        })
+        for n, chunk in enumerate(chunks)
+    )
+    batch_file = await openai_client.files.create(
+        file=("classification_batch.jsonl", requests_jsonl.encode("utf-8")),
+        purpose="batch"
+    )
+    batch = await openai_client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    
+    # Poll until the batch reaches a terminal state
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch = await openai_client.batches.retrieve(batch.id)
+    
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"OpenAI batch {batch.id} finished with status '{batch.status}'")
     
+    output_file = await openai_client.files.content(batch.output_file_id)
+    results = {}
+    for line in output_file.text.splitlines():
+        if line.strip():
+            result = json.loads(line)
+            results[result["custom_id"]] = result["response"]["body"]["choices"][0]["message"]["content"]
+    
+    labels = []
+    for n, chunk in enumerate(chunks):
+        if f"chunk-{n}" not in results:
+            raise RuntimeError(f"OpenAI batch {batch.id} returned no result for chunk {n}")
+        labels.extend(parse_classification_labels(results[f"chunk-{n}"], len(chunk)))
+    
+    return labels
+
+def _label_cache_key(text):
+    """Key a paragraph text in the label cache"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def load_cached_labels(texts):
+    """
+    Return a dict mapping each of the given texts that was classified before to its label.
+    An unreadable cache is logged and treated as a miss for every text.
     """
-    for item in content:
-        prompt += f"\nText: {item['text']}\n"
+    texts_by_key = {_label_cache_key(text): text for text in texts}
+    keys = list(texts_by_key)
+    cached = {}
     
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a document formatting assistant. Classify each paragraph as 'heading' or 'body' based on its content and context."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=1500
-        )
+        with closing(sqlite3.connect(CLASSIFICATION_CACHE_PATH)) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS labels (key TEXT PRIMARY KEY, label TEXT NOT NULL)")
+            # Query in batches to stay under SQLite's bound parameter limit
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(f"SELECT key, label FROM labels WHERE key IN ({placeholders})", batch)
+                for key, label in rows:
+                    cached[texts_by_key[key]] = label
+    except sqlite3.Error as e:
+        logger.warning("Could not read the label cache at %s: %s", CLASSIFICATION_CACHE_PATH, e)
+        return {}
+    
+    return cached
+
+def store_cached_labels(labels_by_text):
+    """Save classified paragraph texts to the label cache, logging instead of failing if it's not writable"""
+    try:
+        with closing(sqlite3.connect(CLASSIFICATION_CACHE_PATH)) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS labels (key TEXT PRIMARY KEY, label TEXT NOT NULL)")
+            conn.executemany(
+                "INSERT OR REPLACE INTO labels (key, label) VALUES (?, ?)",
+                [(_label_cache_key(text), label) for text, label in labels_by_text.items()]
+            )
+    except sqlite3.Error as e:
+        logger.warning("Could not write the label cache at %s: %s", CLASSIFICATION_CACHE_PATH, e)
+
+async def classify_paragraphs(openai_client, texts, system_prompt, model=CLASSIFICATION_MODEL,
+                              use_batch_api=False, on_label=None):
+    """
+    Classify each paragraph text as 'heading' or 'body' using OpenAI.
+    on_label(index, label) is called early for labels that arrive while responses stream in.
+    """
+    if not texts:
+        return []
+    
+    if use_batch_api and len(texts) > BATCH_API_THRESHOLD:
+        return await classify_paragraphs_with_batch_api(openai_client, texts, system_prompt, model)
+    
+    chunks = []
+    for i in range(0, len(texts), CLASSIFICATION_CHUNK_SIZE):
+        chunks.append(texts[i:i + CLASSIFICATION_CHUNK_SIZE])
+    
+    def chunk_callback(offset):
+        if on_label is None:
+            return None
+        return lambda index, label: on_label(offset + index, label)
+    
+    results = await asyncio.gather(*[
+        classify_chunk(openai_client, chunk, system_prompt, model, chunk_callback(n * CLASSIFICATION_CHUNK_SIZE))
+        for n, chunk in enumerate(chunks)
+    ])
+    return [label for chunk_labels in results for label in chunk_labels]
+
+async def classify_texts_by_model(openai_client, texts_by_model, system_prompt, use_batch_api=False, on_label=None):
+    """
+    Classify each model's texts with that model, all concurrently, and return the labels keyed by text.
+    on_label(text, label) is called early for labels that arrive while responses stream in.
+    """
+    def text_callback(texts):
+        if on_label is None:
+            return None
+        return lambda index, label: on_label(texts[index], label)
+    
+    results = await asyncio.gather(*[
+        classify_paragraphs(openai_client, texts, system_prompt, model, use_batch_api, text_callback(texts))
+        for model, texts in texts_by_model.items()
+    ])
+    
+    labels_by_text = {}
+    for texts, labels in zip(texts_by_model.values(), results):
+        labels_by_text.update(zip(texts, labels))
+    return labels_by_text
+
+def apply_font_formatting(font, font_props):
+    """Apply reference character formatting to a style's font"""
+    if font_props.get("bold") is not None:
+        font.bold = font_props["bold"]
+    if font_props.get("italic") is not None:
+        font.italic = font_props["italic"]
+    if font_props.get("font_name"):
+        font.name = font_props["font_name"]
+    if font_props.get("font_size"):
+        font.size = Pt(font_props["font_size"])
+    if font_props.get("color"):
+        try:
+            font.color.rgb = RGBColor.from_string(font_props["color"])
+        except:
+            # Handle case where color can't be set
+            pass
+
+def add_reference_style(target_doc, name, base_style_name):
+    """Add (or reuse) a paragraph style in the target document, based on an existing style if it's there"""
+    styles = target_doc.styles
+    style = styles[name] if name in styles else styles.add_style(name, WD_STYLE_TYPE.PARAGRAPH)
+    style.base_style = styles[base_style_name] if base_style_name in styles else None
+    return style
+
+def _style_run_tags(style):
+    """Tags of the run properties a style sets, which direct run formatting would otherwise override"""
+    font = style.font
+    tags = set()
+    if font.bold is not None:
+        tags.add(W_B)
+    if font.italic is not None:
+        tags.add(W_I)
+    if font.name:
+        tags.add(W_RFONTS)
+    if font.size:
+        tags.add(W_SZ)
+    if font.color.type is not None:
+        tags.add(W_COLOR)
+    return tags
+
+def _reference_style_entry(style):
+    """Build the prototype w:pStyle element and overridden run tags used to apply a reference style"""
+    return {
+        "style_id": style.style_id,
+        "pStyle": OxmlElement("w:pStyle", {W_VAL: style.style_id}),
+        "run_tags": _style_run_tags(style)
+    }
+
+def build_reference_styles(target_doc, formatting_info):
+    """
+    Register the reference heading and body formatting as shared paragraph styles in the target document,
+    so each paragraph only needs its style set. Returns a dict per label with a prototype w:pStyle element
+    referencing the style and the run property tags the style overrides.
+    """
+    # Heading style, based on the reference heading style or Heading 1
+    ref_heading = formatting_info["headings"][0] if formatting_info["headings"] else None
+    base_name = "Heading 1"
+    if ref_heading and ref_heading.get("style_name") in target_doc.styles:
+        base_name = ref_heading["style_name"]
+    heading_style = add_reference_style(target_doc, "RefHeading", base_name)
+    
+    if heading_style.base_style is None:
+        # If Heading 1 style doesn't exist, just make it bold and larger
+        heading_style.font.bold = True
+        heading_style.font.size = Pt(16)
+    
+    if ref_heading:
+        if ref_heading.get("alignment") is not None:
+            heading_style.paragraph_format.alignment = ref_heading["alignment"]
+        if ref_heading["font_properties"]:
+            apply_font_formatting(heading_style.font, ref_heading["font_properties"][0])
+    else:
+        # Default heading formatting if no reference
+        heading_style.font.bold = True
+    
+    reference_styles = {"heading": _reference_style_entry(heading_style)}
+    
+    # Body style, only when there's a reference paragraph; otherwise body paragraphs keep their own formatting
+    if formatting_info["paragraphs"]:
+        ref_para = formatting_info["paragraphs"][0]
+        default_style = target_doc.styles.default(WD_STYLE_TYPE.PARAGRAPH)
+        body_style = add_reference_style(target_doc, "RefBody", default_style.name if default_style else "Normal")
         
-        classifications = response.choices[0].message.content
+        if ref_para.get("alignment") is not None:
+            body_style.paragraph_format.alignment = ref_para["alignment"]
+        if ref_para["font_properties"]:
+            apply_font_formatting(body_style.font, ref_para["font_properties"][0])
+        
+        reference_styles["body"] = _reference_style_entry(body_style)
+    
+    return reference_styles
+
+def format_paragraph(p, label, reference_styles, strip_runs=True):
+    """Apply the reference formatting to a classified w:p paragraph element of the target document in place"""
+    reference = reference_styles.get(label)
+    if reference is None:
+        return
+    
+    # Point an existing w:pStyle at the style, or insert a copy of the prototype as the first w:pPr child
+    pPr = p.get_or_add_pPr()
+    pStyle = pPr.find(W_PSTYLE)
+    if pStyle is not None:
+        pStyle.set(W_VAL, reference["style_id"])
+    else:
+        pPr.insert(0, copy.deepcopy(reference["pStyle"]))
+    
+    # Drop direct run formatting that would hide the shared style's formatting; this can't be
+    # undone, so it is skipped for provisional labels
+    run_tags = reference["run_tags"]
+    if strip_runs and run_tags:
+        for r in _paragraph_runs(p):
+            rPr = r.find(W_RPR)
+            if rPr is not None:
+                for child in list(rPr):
+                    if child.tag in run_tags:
+                        rPr.remove(child)
+
+def iter_target_paragraphs(target_doc):
+    """
+    Lazily yield (element, text, label) for each non-empty body paragraph of the target document.
+    The label is 'heading' when the style marks the paragraph as one, 'body' for trivial paragraphs
+    and None when the paragraph still needs classifying.
+    """
+    style_names, default_style_name = _paragraph_style_names(target_doc)
+    for p in target_doc.element.body.iterchildren(W_P):
+        text = _paragraph_text(p)
+        if text.strip():
+            style_name = style_names.get(_read_attribute(p.find(W_PPR), W_PSTYLE, W_VAL), default_style_name)
+            label = classify_by_style(p, style_name)
+            if label is None and is_trivial_paragraph(text):
+                label = "body"
+            yield p, text, label
+
+def apply_formatting_to_docx(target_doc, formatting_info, openai_client, use_batch_api=False):
+    """
+    Apply formatting from reference document to target document using OpenAI.
+    This function will use OpenAI to understand the document structure and 
+    then apply the formatting from the reference document to the target document in place,
+    so images, comments, fields and sections are preserved.
+    """
+    # Set document-wide properties
+    overall_style = formatting_info["overall_style"]
+    if overall_style.get("margins"):
+        # Convert the margins once rather than for every section
+        margins = {
+            side: Inches(inches) for side, inches in overall_style["margins"].items() if inches
+        }
+        for section in target_doc.sections:
+            if "top" in margins:
+                section.top_margin = margins["top"]
+            if "bottom" in margins:
+                section.bottom_margin = margins["bottom"]
+            if "left" in margins:
+                section.left_margin = margins["left"]
+            if "right" in margins:
+                section.right_margin = margins["right"]
+    
+    try:
+        reference_styles = build_reference_styles(target_doc, formatting_info)
         
-        # Parse OpenAI's response to get classifications
-        lines = classifications.lower().split("\n")
-        classified_paragraphs = []
+        # Paragraphs labelled from their style are formatted while the body is scanned,
+        # only the undecided ones are kept around
+        undecided = []
+        for p, text, label in iter_target_paragraphs(target_doc):
+            if label is None:
+                undecided.append((p, text))
+            else:
+                format_paragraph(p, label, reference_styles)
         
-        # Improved parsing to handle various response formats
-        for i, item in enumerate(content):
-            # Try to find a classification for this paragraph
-            classification = None
-            for line in lines:
-                if item["text"][:20].lower() in line.lower():
-                    if "heading" in line.lower():
-                        classification = "heading"
-                    else:
-                        classification = "body"
-                    break
-            
-            # If no specific match found, use index-based approach as fallback
-            if classification is None and i < len(lines):
-                if "heading" in lines[i].lower():
-                    classification = "heading"
-                else:
-                    classification = "body"
-            
-            # Default to body if still no classification
-            if classification is None:
-                classification = "body"
-                
-            classified_paragraphs.append({"type": classification, "text": item["text"]})
+        # Score the undecided paragraphs from their text and run features
+        ambiguous = []
+        labels, confidences = classify_by_features([heading_features(p, text) for p, text in undecided])
+        for (p, text), label, confidence in zip(undecided, labels, confidences):
+            if label is None:
+                ambiguous.append((p, text.strip(), route_model(confidence)))
+            else:
+                format_paragraph(p, label, reference_styles)
         
-        # Apply formatting based on classifications
-        for item in classified_paragraphs:
-            if item["type"] == "heading":
-                # Apply heading formatting
-                if formatting_info["headings"]:
-                    ref_heading = formatting_info["headings"][0]
-                    p = new_doc.add_paragraph()
-                    run = p.add_run(item["text"])
-                    
-                    if ref_heading.get("alignment") is not None:
-                        p.alignment = ref_heading["alignment"]
-                    
-                    # Try to find the heading style
-                    if ref_heading.get("style_name") and ref_heading["style_name"] in new_doc.styles:
-                        p.style = ref_heading["style_name"]
-                    else:
-                        # Default to Heading 1 if the specific style doesn't exist
-                        try:
-                            p.style = "Heading 1"
-                        except:
-                            # If Heading 1 style doesn't exist, just make it bold and larger
-                            run.bold = True
-                            run.font.size = Pt(16)
-                    
-                    # Apply character formatting from reference
-                    if ref_heading["font_properties"]:
-                        font_props = ref_heading["font_properties"][0]
-                        if font_props.get("bold") is not None:
-                            run.bold = font_props["bold"]
-                        if font_props.get("italic") is not None:
-                            run.italic = font_props["italic"]
-                        if font_props.get("font_name"):
-                            run.font.name = font_props["font_name"]
-                        if font_props.get("font_size"):
-                            run.font.size = Pt(font_props["font_size"])
-                        if font_props.get("color"):
-                            try:
-                                run.font.color.rgb = font_props["color"]
-                            except:
-                                # Handle case where color can't be set
-                                pass
-                else:
-                    # Default heading formatting if no reference
-                    p = new_doc.add_paragraph()
-                    run = p.add_run(item["text"])
-                    run.bold = True
-                    try:
-                        p.style = "Heading 1"
-                    except:
-                        run.font.size = Pt(16)
+        # Use OpenAI only for the paragraphs the local heuristic could not classify. Labels of
+        # previously classified texts are reused, and each remaining text is sent only once
+        cached_labels = load_cached_labels({text for _, text, _ in ambiguous})
+        pending = {}
+        text_models = {}
+        for p, text, model in ambiguous:
+            if text in cached_labels:
+                format_paragraph(p, cached_labels[text], reference_styles)
             else:
-                # Apply body paragraph formatting
-                if formatting_info["paragraphs"]:
-                    ref_para = formatting_info["paragraphs"][0]
-                    p = new_doc.add_paragraph()
-                    run = p.add_run(item["text"])
-                    
-                    if ref_para.get("alignment") is not None:
-                        p.alignment = ref_para["alignment"]
-                    
-                    # Apply character formatting from reference
-                    if ref_para["font_properties"]:
-                        font_props = ref_para["font_properties"][0]
-                        if font_props.get("bold") is not None:
-                            run.bold = font_props["bold"]
-                        if font_props.get("italic") is not None:
-                            run.italic = font_props["italic"]
-                        if font_props.get("font_name"):
-                            run.font.name = font_props["font_name"]
-                        if font_props.get("font_size"):
-                            run.font.size = Pt(font_props["font_size"])
-                        if font_props.get("color"):
-                            try:
-                                run.font.color.rgb = font_props["color"]
-                            except:
-                                # Handle case where color can't be set
-                                pass
-                else:
-                    # Default paragraph formatting if no reference
-                    p = new_doc.add_paragraph(item["text"])
-                    
-        return new_doc
+                pending.setdefault(text, []).append(p)
+                # A repeated text goes to the stronger model if any occurrence needs it
+                if text_models.get(text) != ESCALATION_MODEL:
+                    text_models[text] = model
+        
+        texts_by_model = {}
+        for text, model in text_models.items():
+            texts_by_model.setdefault(model, []).append(text)
+        system_prompt = build_classification_system_prompt(formatting_info)
+        
+        # Point paragraphs at their style as soon as their labels are known, so editing the
+        # document overlaps with the streamed OpenAI responses
+        def on_label(text, label):
+            for p in pending[text]:
+                format_paragraph(p, label, reference_styles, strip_runs=False)
+        
+        labels_by_text = asyncio.run(
+            classify_texts_by_model(openai_client, texts_by_model, system_prompt, use_batch_api, on_label)
+        )
+        
+        # Streamed labels are provisional (a retried or malformed response may have reported
+        # wrong ones), so only the validated labels re-point the style and strip run formatting
+        for text, label in labels_by_text.items():
+            for p in pending[text]:
+                format_paragraph(p, label, reference_styles)
+        store_cached_labels(labels_by_text)
+        
+        return target_doc
     
     except Exception as e:
         st.error(f"Error using OpenAI API: {str(e)}")
         return None
 
+@st.cache_data(show_spinner=False, max_entries=16)
+def _cached_extract(file_bytes):
+    """Extract formatting from a reference file, cached on its contents across reruns"""
+    return extract_formatting_from_docx(docx.Document(io.BytesIO(file_bytes)))
+
 def main():
     st.title("Document Formatter with OpenAI")
     st.write("Upload a reference document and a target document to apply the same formatting.")
     
     api_key = st.text_input("Enter your OpenAI API key", type="password")
+    use_batch_api = st.checkbox(
+        "Use the OpenAI Batch API for large documents (half the cost, but can take much longer)"
+    )
     
     col1, col2 = st.columns(2)
     
@@ -260,18 +902,17 @@ def main():
     if api_key and reference_file and target_file:
         try:
             # Set up OpenAI client
-            client = openai.OpenAI(api_key=api_key)
+            client = openai.AsyncOpenAI(api_key=api_key)
             
-            # Load documents
-            reference_doc = docx.Document(reference_file)
+            # Load the target document, the reference is parsed by the cached extraction
             target_doc = docx.Document(target_file)
             
             if st.button("Format Document"):
                 with st.spinner("Extracting formatting from reference document..."):
-                    formatting_info = extract_formatting_from_docx(reference_doc)
+                    formatting_info = _cached_extract(reference_file.getvalue())
                 
                 with st.spinner("Applying formatting to target document..."):
-                    formatted_doc = apply_formatting_to_docx(target_doc, formatting_info, client)
+                    formatted_doc = apply_formatting_to_docx(target_doc, formatting_info, client, use_batch_api)
                 
                 if formatted_doc:
                     st.success("Document formatted successfully!")